@@ -10,6 +10,7 @@ import traceback
 from processors.snapshot_processor import OptionSnapshotProcessor
 from processors.lifetime_processor import OptionLifetimeProcessor
 from processors.permutation_processor import OptionPermutationProcessor
+from processors.sqlite_writer import SqliteWriter
 
 # --- DEBUG INSTRUMENTATION: signal + exception + thread hooks ----------------
 import sys
@@ -75,31 +76,44 @@ for handler in logger.logger.handlers:
 async def lifespan(app: FastAPI):
     logger.logMessage("Starting FastAPI lifespan...")
 
+    # single writer thread shared by the snapshot and permutation processors
+    sqlite_writer = SqliteWriter(db_path=str(DB_PATH))
+    sqlite_writer.start()
+    logger.logMessage("SQLite writer started")
+
     # snapshot processor (example: using same constructor you had)
     snapshot_processor = OptionSnapshotProcessor(
         db_path=str(DB_PATH),
         incoming_folder=SAVE_DIR,
-        check_interval=5
+        check_interval=5,
+        writer=sqlite_writer
     )
-    snapshot_processor.start()
-    logger.logMessage("Snapshot processor started")
 
     # lifetime processor
     lifetime_processor = OptionLifetimeProcessor(
         db_path=str(DB_PATH),
         check_interval=60
     )
-    lifetime_processor.start()
-    logger.logMessage("Lifetime processor started")
 
     # permutation processor - ensure we pass DB_PATH
     permutation_processor = OptionPermutationProcessor(
         db_path=str(DB_PATH),
         check_interval=45,
         batch_commit_size=100,
-        analyze_after_commits=1,
-        vacuum_interval_hours=24
+        vacuum_interval_hours=24,
+        writer=sqlite_writer
     )
+
+    # each stage wakes the next as soon as it commits, so check_interval is only
+    # a fallback; wired after construction since each one creates the tables
+    # the next reads
+    snapshot_processor.on_ingested = lifetime_processor.wake
+    lifetime_processor.on_archived = permutation_processor.wake
+
+    snapshot_processor.start()
+    logger.logMessage("Snapshot processor started")
+    lifetime_processor.start()
+    logger.logMessage("Lifetime processor started")
     permutation_processor.start()
     logger.logMessage("Permutation processor started")
 
@@ -107,6 +121,7 @@ async def lifespan(app: FastAPI):
     app.state.snapshot_processor = snapshot_processor
     app.state.lifetime_processor = lifetime_processor
     app.state.permutation_processor = permutation_processor
+    app.state.sqlite_writer = sqlite_writer
 
     # start log monitor thread (unchanged)
     def log_monitor():
@@ -122,7 +137,8 @@ async def lifespan(app: FastAPI):
         logger.logMessage(f"Lifespan crash: {e}\n{traceback.format_exc()}")
     finally:
         logger.logMessage("Server shutdown started...")
-        for proc in (snapshot_processor, lifetime_processor, permutation_processor):
+        # writer last, so processors can flush their in-flight units
+        for proc in (snapshot_processor, lifetime_processor, permutation_processor, sqlite_writer):
             try:
                 if proc:
                     proc.stop()
@@ -2,19 +2,23 @@
 """
 OptionLifetimeProcessor
 - Moves completed OSI snapshot groups from option_snapshots -> option_lifetimes.
-- Uses WAL, busy_timeout, short-lived per-OSI transactions with BEGIN IMMEDIATE.
-- Designed to minimize lock contention with brief transactions and retries.
+- Uses WAL, busy_timeout and a short per-OSI BEGIN IMMEDIATE transaction on the loop thread's
+  long-lived connection.
+- Designed to minimize lock contention with brief transactions and jittered retries.
 """
 
+import random
 import sqlite3
 import threading
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Callable, Optional, List, Dict, Any
 
 from shared_options.log.logger_singleton import getLogger
 
+from processors.utils import is_busy_error
+
 logger = getLogger()
 
 class LifetimeProcessorStatus:
@@ -45,6 +49,8 @@ class OptionLifetimeProcessor:
         min_snapshots: int = 5,
         sqlite_timeout: float = 30.0,
         max_retries_per_osi: int = 3,
+        min_wake_interval: float = 5.0,
+        on_archived: Optional[Callable[[], None]] = None,
     ):
         self.db_path = Path(db_path)
         self.check_interval = int(check_interval)
@@ -52,14 +58,42 @@ class OptionLifetimeProcessor:
         self.min_snapshots = int(min_snapshots)
         self.sqlite_timeout = float(sqlite_timeout)
         self.max_retries_per_osi = int(max_retries_per_osi)
+        # wake() fires after every ingest pass; scans start at most this often
+        self.min_wake_interval = float(min_wake_interval)
+        # called after a batch archives OSIs, e.g. OptionPermutationProcessor.wake
+        self.on_archived = on_archived
 
         self._stop_event = threading.Event()
+        # set by wake() (new snapshots ingested) or stop() to cut the idle sleep short
+        self._wake = threading.Event()
         self._thread: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None  # owned by the run loop thread
         self._status = LifetimeProcessorStatus()
         self._status_lock = threading.Lock()
 
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
 
+        # hot-path statements are fixed; build them once so every batch reuses the
+        # same strings (and sqlite3's cached prepared statements)
+        cols = ", ".join(self.SNAPSHOT_COLUMNS)
+        self._select_expired_sql = f"""
+            SELECT osiKey
+            FROM {self.SNAPSHOT_TABLE}
+            GROUP BY osiKey
+            HAVING MAX(daysToExpiration) <= 0
+            LIMIT ?
+        """
+        self._count_sql = f"SELECT COUNT(*) FROM {self.SNAPSHOT_TABLE} WHERE osiKey = ?"
+        # copy rows inside SQLite: one statement per OSI instead of a fetch plus a
+        # bind/step/reset cycle per snapshot through executemany
+        self._archive_sql = f"""
+            INSERT OR REPLACE INTO {self.LIFETIME_TABLE} ({cols})
+            SELECT {cols}
+            FROM {self.SNAPSHOT_TABLE}
+            WHERE osiKey = ?
+        """
+        self._delete_snapshots_sql = f"DELETE FROM {self.SNAPSHOT_TABLE} WHERE osiKey = ?"
+
         self._init_lifetime_table()
         self._ensure_indexes()
 
@@ -69,13 +103,41 @@ class OptionLifetimeProcessor:
     def _get_conn(self) -> sqlite3.Connection:
         conn = sqlite3.connect(str(self.db_path), timeout=self.sqlite_timeout, isolation_level=None)
         try:
+            # before WAL, or a fresh file never switches to incremental auto_vacuum
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
             conn.execute("PRAGMA journal_mode=WAL;")
             conn.execute("PRAGMA synchronous=NORMAL;")
             conn.execute("PRAGMA busy_timeout=30000;")
+            # bulk writes: big page cache, mmap reads, in-memory temp b-trees
+            conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
+            conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+            conn.execute("PRAGMA temp_store=MEMORY;")
         except Exception:
             pass
         return conn
 
+    def _loop_conn(self) -> sqlite3.Connection:
+        # reused across batches so the page cache stays warm and pragmas run once
+        if self._conn is None:
+            self._conn = self._get_conn()
+        return self._conn
+
+    def _close_loop_conn(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    @staticmethod
+    def _rollback(conn: sqlite3.Connection) -> None:
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+        except Exception:
+            pass
+
     # -------------------------
     # init
     # -------------------------
@@ -112,7 +174,7 @@ class OptionLifetimeProcessor:
                     PRIMARY KEY (osiKey, timestamp)
                 );
             """)
-            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.LIFETIME_TABLE}_osi ON {self.LIFETIME_TABLE}(osiKey);")
+            # PRIMARY KEY (osiKey, timestamp) already indexes osiKey lookups and GROUP BY osiKey
             conn.commit()
             conn.close()
             logger.logMessage("[LifetimeProcessor] Lifetime table initialized.")
@@ -150,8 +212,13 @@ class OptionLifetimeProcessor:
         self._thread.start()
         logger.logMessage("[LifetimeProcessor] Processor started.")
 
+    def wake(self) -> None:
+        """Look for expired OSIs now instead of after check_interval; safe from any thread."""
+        self._wake.set()
+
     def stop(self, join_timeout: float = 10.0) -> None:
         self._stop_event.set()
+        self._wake.set()
         if self._thread:
             self._thread.join(timeout=join_timeout)
         logger.logMessage("[LifetimeProcessor] Processor stopped.")
@@ -176,12 +243,16 @@ class OptionLifetimeProcessor:
         logger.logMessage("[LifetimeProcessor] Run loop entered.")
         while not self._stop_event.is_set():
             try:
+                scan_started = time.monotonic()
                 processed = self._process_one_batch()
                 with self._status_lock:
                     self._status.last_run = datetime.utcnow()
                     self._status.last_processed_batch_size = processed
                 if processed == 0:
-                    time.sleep(self.check_interval)
+                    if self._wake.wait(self.check_interval):
+                        # woken early: hold off until min_wake_interval, folding in later wakes
+                        self._stop_event.wait(scan_started + self.min_wake_interval - time.monotonic())
+                    self._wake.clear()
                 else:
                     time.sleep(0.1)
             except Exception as e:
@@ -189,33 +260,21 @@ class OptionLifetimeProcessor:
                 with self._status_lock:
                     self._status.last_error = str(e)
                 time.sleep(5)
+        self._close_loop_conn()
         logger.logMessage("[LifetimeProcessor] Run loop exited.")
 
     # -------------------------
-    # batch processing (select candidates using short connection)
+    # batch processing (loop thread's long-lived connection)
     # -------------------------
     def _process_one_batch(self) -> int:
-        conn = self._get_conn()
-        c = conn.cursor()
+        conn = self._loop_conn()
         try:
-            c.execute(f"""
-                SELECT osiKey
-                FROM {self.SNAPSHOT_TABLE}
-                GROUP BY osiKey
-                HAVING MAX(daysToExpiration) <= 0
-                LIMIT ?
-            """, (self.batch_size,))
-            rows = c.fetchall()
-            osi_keys = [r[0] for r in rows]
+            c = conn.cursor()
+            c.execute(self._select_expired_sql, (self.batch_size,))
+            osi_keys = [r[0] for r in c.fetchall()]
         except sqlite3.OperationalError as e:
             logger.logMessage(f"[LifetimeProcessor] SQLite error selecting OSIs: {e}")
-            conn.close()
             return 0
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
         if not osi_keys:
             return 0
@@ -223,72 +282,44 @@ class OptionLifetimeProcessor:
         archived = 0
         deleted_small = 0
 
-        placeholders = ", ".join(["?"] * len(self.SNAPSHOT_COLUMNS))
-        insert_sql = f"INSERT OR REPLACE INTO {self.LIFETIME_TABLE} ({', '.join(self.SNAPSHOT_COLUMNS)}) VALUES ({placeholders})"
-
         for osi in osi_keys:
-            attempts = 0
-            success = False
-            while attempts < self.max_retries_per_osi and not success:
-                attempts += 1
-                conn2 = None
+            for attempt in range(1, self.max_retries_per_osi + 1):
                 try:
-                    conn2 = self._get_conn()
-                    cur2 = conn2.cursor()
-                    # fetch snapshots for this OSI
-                    cur2.execute(f"""
-                        SELECT {', '.join(self.SNAPSHOT_COLUMNS)}
-                        FROM {self.SNAPSHOT_TABLE}
-                        WHERE osiKey = ?
-                        ORDER BY timestamp ASC
-                    """, (osi,))
-                    snaps = cur2.fetchall()
-
-                    if not snaps:
-                        success = True
-                        break
+                    # take the write lock up front: a deferred transaction that reads
+                    # first fails with SQLITE_BUSY on upgrade without waiting on
+                    # busy_timeout, while BEGIN IMMEDIATE waits for the lock
+                    conn.execute("BEGIN IMMEDIATE;")
+                    cur = conn.cursor()
+                    cur.execute(self._count_sql, (osi,))
+                    n_snaps = cur.fetchone()[0]
 
-                    if len(snaps) < self.min_snapshots:
-                        # delete snapshots with too few rows -- short transaction
-                        conn2.execute("BEGIN IMMEDIATE;")
-                        cur2.execute(f"DELETE FROM {self.SNAPSHOT_TABLE} WHERE osiKey = ?", (osi,))
-                        conn2.execute("COMMIT;")
+                    if n_snaps and n_snaps < self.min_snapshots:
+                        # delete snapshots with too few rows
+                        cur.execute(self._delete_snapshots_sql, (osi,))
                         deleted_small += 1
-                        success = True
-                        break
-
-                    # Archive within a short transaction (INSERT then DELETE)
-                    conn2.execute("BEGIN IMMEDIATE;")
-                    cur2.executemany(insert_sql, snaps)
-                    cur2.execute(f"DELETE FROM {self.SNAPSHOT_TABLE} WHERE osiKey = ?", (osi,))
-                    conn2.execute("COMMIT;")
-                    archived += 1
-                    success = True
+                    elif n_snaps:
+                        # archive (INSERT then DELETE) in the same transaction
+                        cur.execute(self._archive_sql, (osi,))
+                        cur.execute(self._delete_snapshots_sql, (osi,))
+                        archived += 1
+                    conn.execute("COMMIT;")
+                    break
 
                 except sqlite3.OperationalError as e:
-                    try:
-                        if conn2:
-                            conn2.execute("ROLLBACK;")
-                    except Exception:
-                        pass
-                    logger.logMessage(f"[LifetimeProcessor] OperationalError osi={osi}: {e} (attempt {attempts})")
-                    time.sleep(0.1 * attempts)
+                    self._rollback(conn)
+                    logger.logMessage(f"[LifetimeProcessor] OperationalError osi={osi}: {e} (attempt {attempt})")
+                    if not is_busy_error(e) or attempt == self.max_retries_per_osi:
+                        with self._status_lock:
+                            self._status.last_error = str(e)
+                        break
+                    # exponential backoff with jitter so competing writers spread out
+                    time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
                 except Exception as e:
-                    try:
-                        if conn2:
-                            conn2.execute("ROLLBACK;")
-                    except Exception:
-                        pass
+                    self._rollback(conn)
                     logger.logMessage(f"[LifetimeProcessor] Error processing osi={osi}: {e}")
                     with self._status_lock:
                         self._status.last_error = str(e)
                     break
-                finally:
-                    if conn2:
-                        try:
-                            conn2.close()
-                        except Exception:
-                            pass
 
         with self._status_lock:
             self._status.total_archived += archived
@@ -296,6 +327,8 @@ class OptionLifetimeProcessor:
 
         if archived:
             logger.logMessage(f"[LifetimeProcessor] Archived {archived} OSIs (batch_size={self.batch_size}).")
+            if self.on_archived is not None:
+                self.on_archived()
         if deleted_small:
             logger.logMessage(f"[LifetimeProcessor] Deleted {deleted_small} small OSIs (<{self.min_snapshots}).")
 
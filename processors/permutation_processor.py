@@ -2,30 +2,49 @@
 """
 OptionPermutationProcessor
 - Reads completed option lifetimes and generates permutations (buy at i, sell at j>i).
-- Uses short-lived per-OSI DB connections and transactions with BEGIN IMMEDIATE.
-- Avoids VACUUM during normal operation. Uses ANALYZE occasionally (safe).
+- Pairs are expanded inside SQLite: each OSI is copied into an rn-keyed temp table,
+  then one INSERT ... SELECT self-join (range seeks when windowed) writes its pairs.
+- Commits a whole batch of OSIs in one BEGIN IMMEDIATE transaction (savepoint per OSI),
+  or submits one unit per OSI to a shared SqliteWriter when one is configured.
+- ANALYZE runs from the loop between batches; incremental vacuuming only once the
+  backlog is drained. Never runs a full VACUUM: do that from a maintenance script
+  while the server is down.
 """
 
+import bisect
+import hashlib
+import math
+import random
 import sqlite3
 import threading
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Optional, List, Dict, Tuple
 
 from shared_options.log.logger_singleton import getLogger
 
+from processors.sqlite_writer import DEFAULT_RESULT_TIMEOUT, SqliteWriter
+from processors.utils import is_busy_error
+
 logger = getLogger()
 
 # Configuration defaults (adjust when instantiating)
 DEFAULT_BATCH_COMMIT_SIZE = 50
 DEFAULT_CHECK_INTERVAL = 60
-DEFAULT_ANALYZE_AFTER_COMMITS = 1
+DEFAULT_ANALYZE_AFTER_COMMITS = 500
+DEFAULT_ANALYZE_MIN_INTERVAL = timedelta(hours=1)
 DEFAULT_VACUUM_INTERVAL_HOURS = 24
+DEFAULT_INCREMENTAL_VACUUM_PAGES = 4096  # 16 MiB of free pages per pass at 4 KiB pages
 DEFAULT_INSERT_RETRIES = 5
-DEFAULT_INSERT_RETRY_BACKOFF = 0.1  # base seconds
+DEFAULT_INSERT_RETRY_BACKOFF = 0.05  # base seconds (exponential, plus jitter)
+DEFAULT_INSERT_RETRY_BACKOFF_CAP = 5.0
+DEFAULT_MAX_PAIRS_PER_OSI = 250_000
 
 _RESERVED_COLUMNS = {"osiKey", "timestamp", "buy_timestamp", "sell_timestamp", "processed"}
+# julianday rounds each timestamp to the ms, so jd-based hold windows widen by this much
+_JD_SLACK_SECONDS = 0.002
 
 
 def _normalize_sql_type(t: Optional[str]) -> str:
@@ -41,9 +60,16 @@ def _normalize_sql_type(t: Optional[str]) -> str:
     return "REAL"
 
 
+def _num(col: str) -> str:
+    # SQL twin of float(v) if v is not None else 0.0
+    return f"CAST(IFNULL({col}, 0) AS REAL)"
+
+
+
 class OptionPermutationProcessor:
     LIFETIME_TABLE = "option_lifetimes"
     PERM_TABLE = "option_permutations"
+    SCHEMA_META_TABLE = "schema_meta"
 
     def __init__(
         self,
@@ -53,24 +79,58 @@ class OptionPermutationProcessor:
         analyze_after_commits: int = DEFAULT_ANALYZE_AFTER_COMMITS,
         vacuum_interval_hours: int = DEFAULT_VACUUM_INTERVAL_HOURS,
         insert_retries: int = DEFAULT_INSERT_RETRIES,
+        max_pairs_per_osi: int = DEFAULT_MAX_PAIRS_PER_OSI,
+        max_hold_seconds: Optional[float] = None,
+        max_pair_gap: Optional[int] = None,
+        pair_sample_seed: Optional[int] = None,
+        writer: Optional[SqliteWriter] = None,
     ):
         self.db_path = Path(db_path)
         self.check_interval = int(check_interval)
         self.batch_commit_size = int(batch_commit_size)
         self.analyze_after_commits = max(1, int(analyze_after_commits))
         self.vacuum_interval = timedelta(hours=int(vacuum_interval_hours))
+        # optional shared writer thread: per-OSI writes go through its queue, while
+        # our own writer connection is kept for ANALYZE / incremental vacuum
+        self.writer = writer
         self.insert_retries = max(1, int(insert_retries))
+        self.max_pairs_per_osi = max(1, int(max_pairs_per_osi))
+        # optional holding-window bounds: O(N^2) pairs become O(N*W)
+        self.max_hold_seconds = float(max_hold_seconds) if max_hold_seconds is not None else None
+        self.max_pair_gap = max(1, int(max_pair_gap)) if max_pair_gap is not None else None
+        # over max_pairs_per_osi: with a seed or a window, insert a reproducible uniform
+        # sample of pairs (every snapshot stays); otherwise stride-downsample the snapshots
+        self.pair_sample_seed = int(pair_sample_seed) if pair_sample_seed is not None else None
 
         self.running = False
         self.thread: Optional[threading.Thread] = None
-
-        # metrics
+        # set by wake() (e.g. when the lifetime processor archives OSIs) so the loop
+        # starts its next pass immediately instead of sleeping out check_interval
+        self._wake = threading.Event()
+        # set by stop(); batches check it between OSIs so shutdown never waits out a batch
+        self._stop_event = threading.Event()
+        # long-lived connections: pragmas run once and the page cache survives
+        # between batches. Reads go through a query_only reader so, under WAL, they
+        # never queue behind the writer. The lock serializes batches against stop().
+        self._write_lock = threading.Lock()
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        self._reader_conn: Optional[sqlite3.Connection] = None
+
+        # metrics: updated once per batch commit; _status_lock gives get_status()
+        # a consistent view without waiting on the (long-held) write lock
+        self._status_lock = threading.Lock()
         self._total_rows_inserted = 0
         self._total_osis_processed = 0
         self._last_run: Optional[datetime] = None
         self._last_error: Optional[str] = None
         self._last_vacuum: Optional[datetime] = None
+        # interval checks use the monotonic clock (cheap, immune to wall-clock jumps);
+        # datetimes are kept only for get_status() display
+        self._last_analyze_mono = time.monotonic()
         self._commit_count = 0
+        # maintenance runs from _loop between batches, never inside the write path
+        self._analyze_due = False
+        self._vacuum_due_mono = time.monotonic() + self.vacuum_interval.total_seconds()
 
         # load snapshot schema (reads lifetime table schema)
         self.snapshot_schema: List[Tuple[str, str]] = self._load_snapshot_schema()
@@ -79,24 +139,72 @@ class OptionPermutationProcessor:
 
         # init permutation table (add missing cols)
         self._init_perm_table()
+        self._ensure_lifetime_index()
+        # permutation rows are generated by SQLite in exactly this column order
+        self._insert_columns: List[str] = list(self._desired_perm_columns())
+        self._build_source_sql()
+        self._insert_sql = self._build_insert_select_sql()
+        self._insert_sampled_sql = self._build_insert_select_sql(sampled=True)
+        # the other hot-path statements are fixed too; build them once so every
+        # execute hits sqlite3's statement cache with the identical string
+        self._fetch_batch_sql = (
+            f"SELECT osiKey, COUNT(*) FROM {self.LIFETIME_TABLE} WHERE osiKey > ? "
+            f"GROUP BY osiKey ORDER BY osiKey LIMIT ?;"
+        )
+        self._delete_lifetimes_sql = f"DELETE FROM {self.LIFETIME_TABLE} WHERE osiKey = ?;"
+        self._delete_capped_lifetimes_sql = (
+            f"DELETE FROM {self.LIFETIME_TABLE} WHERE osiKey = ? "
+            f"AND EXISTS (SELECT 1 FROM {self.PERM_TABLE} WHERE osiKey = ?);"
+        )
+        self._fetch_jd_sql = (
+            f"SELECT julianday(timestamp) FROM {self.LIFETIME_TABLE} WHERE osiKey = ? ORDER BY timestamp;"
+        )
+
+        self._open_loop_conns()
 
         logger.logMessage("[Permutation] Processor initialized.")
 
     # -------------------------
-    # DB helper (short-lived connections only)
+    # DB helper (writer connection + short-lived introspection connections)
     # -------------------------
-    def _get_conn(self) -> sqlite3.Connection:
+    def _get_conn(self, check_same_thread: bool = True) -> sqlite3.Connection:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(str(self.db_path), timeout=30.0, isolation_level=None)
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, isolation_level=None,
+                               check_same_thread=check_same_thread)
         try:
+            # lets _maybe_vacuum reclaim pages incrementally on databases created here
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
             conn.execute("PRAGMA journal_mode=WAL;")
             conn.execute("PRAGMA synchronous=NORMAL;")
-            conn.execute("PRAGMA busy_timeout=30000;")
+            conn.execute("PRAGMA busy_timeout=60000;")  # match the 60s connect timeout
             conn.execute("PRAGMA foreign_keys=ON;")
+            # bulk self-join inserts: big page cache, mmap reads, in-memory temp
+            # b-trees, and fewer WAL checkpoints mid-batch
+            conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
+            conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+            conn.execute("PRAGMA temp_store=MEMORY;")
+            conn.execute("PRAGMA wal_autocheckpoint=10000;")
         except Exception:
             pass
         return conn
 
+    def _open_loop_conns(self):
+        if self._writer_conn is None:
+            self._writer_conn = self._get_conn(check_same_thread=False)
+        if self._reader_conn is None:
+            self._reader_conn = self._get_conn(check_same_thread=False)
+            self._reader_conn.execute("PRAGMA query_only=1;")
+
+    def _close_loop_conns(self):
+        for conn in (self._reader_conn, self._writer_conn):
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        self._reader_conn = None
+        self._writer_conn = None
+
     def _load_snapshot_schema(self) -> List[Tuple[str, str]]:
         conn = self._get_conn()
         cur = conn.cursor()
@@ -129,12 +237,8 @@ class OptionPermutationProcessor:
     # -------------------------
     # create/alter perm table
     # -------------------------
-    def _init_perm_table(self):
-        conn = self._get_conn()
-        cur = conn.cursor()
-
-        dynamic_cols = [col for col, _ in self.snapshot_schema if col not in _RESERVED_COLUMNS]
-
+    def _desired_perm_columns(self) -> Dict[str, str]:
+        """Permutation column -> SQL type, in the canonical INSERT order."""
         buy_sell_defs = []
         for col, col_type in self.snapshot_schema:
             if col in _RESERVED_COLUMNS:
@@ -155,10 +259,42 @@ class OptionPermutationProcessor:
         desired_columns: Dict[str, str] = {"osiKey": "TEXT", "buy_timestamp": "TEXT", "sell_timestamp": "TEXT"}
         for name, t in buy_sell_defs + delta_defs + computed_defs:
             desired_columns[name] = t
+        return desired_columns
+
+    def _read_schema_hash(self, cur: sqlite3.Cursor) -> Optional[str]:
+        try:
+            cur.execute(f"SELECT digest FROM {self.SCHEMA_META_TABLE} WHERE name = ?;", (self.PERM_TABLE,))
+        except sqlite3.OperationalError:
+            return None  # no meta table yet
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def _write_schema_hash(self, cur: sqlite3.Cursor, digest: str):
+        try:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {self.SCHEMA_META_TABLE} "
+                        f"(name TEXT PRIMARY KEY, digest TEXT NOT NULL);")
+            cur.execute(f"INSERT OR REPLACE INTO {self.SCHEMA_META_TABLE} (name, digest) VALUES (?, ?);",
+                        (self.PERM_TABLE, digest))
+        except sqlite3.OperationalError as e:
+            logger.logMessage(f"[Permutation] Could not write schema hash: {e}")
+
+    def _init_perm_table(self):
+        desired_columns = self._desired_perm_columns()
+        # fingerprint of the last reconciled layout, stored in the database itself so
+        # it travels with the file: on a restart with an unchanged schema, skip
+        # table_info and the ALTER loop entirely
+        digest = hashlib.sha256(repr((self.PERM_TABLE, list(desired_columns.items()))).encode()).hexdigest()
+
+        conn = self._get_conn()
+        cur = conn.cursor()
 
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (self.PERM_TABLE,))
         exists = cur.fetchone() is not None
 
+        if exists and self._read_schema_hash(cur) == digest:
+            conn.close()
+            return
+
         if not exists:
             defs_sql = ",\n    ".join([f"{col} {typ}" for col, typ in desired_columns.items()])
             ddl = f"""
@@ -168,7 +304,7 @@ class OptionPermutationProcessor:
                 );
             """
             cur.execute(ddl)
-            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.PERM_TABLE}_osi ON {self.PERM_TABLE}(osiKey);")
+            self._write_schema_hash(cur, digest)
             conn.commit()
             conn.close()
             logger.logMessage("[Permutation] option_permutations table created.")
@@ -182,17 +318,162 @@ class OptionPermutationProcessor:
             if col not in existing:
                 to_add.append((col, typ))
 
+        reconciled = True
         for col, typ in to_add:
             try:
                 cur.execute(f"ALTER TABLE {self.PERM_TABLE} ADD COLUMN {col} {typ};")
             except sqlite3.OperationalError as e:
+                reconciled = False
                 logger.logMessage(f"[Permutation] ALTER TABLE failed for {col}: {e}")
-        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.PERM_TABLE}_osi ON {self.PERM_TABLE}(osiKey);")
+        # the PK (osiKey, buy_timestamp, sell_timestamp) already serves osiKey lookups;
+        # the old standalone index only doubled write cost on bulk inserts
+        cur.execute(f"DROP INDEX IF EXISTS idx_{self.PERM_TABLE}_osi;")
+        if reconciled:
+            self._write_schema_hash(cur, digest)
         conn.commit()
         conn.close()
         if to_add:
             logger.logMessage(f"[Permutation] Added {len(to_add)} missing columns to {self.PERM_TABLE}.")
 
+    def _ensure_lifetime_index(self):
+        """Make sure an (osiKey, timestamp) index exists and drop the redundant osiKey-only one."""
+        conn = self._get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute(f"PRAGMA index_list({self.LIFETIME_TABLE});")
+            for idx in [r[1] for r in cur.fetchall()]:
+                cur.execute(f"PRAGMA index_info({idx});")
+                cols = [r[2] for r in sorted(cur.fetchall())]
+                if cols[:2] == ["osiKey", "timestamp"]:
+                    cur.execute(f"DROP INDEX IF EXISTS idx_{self.LIFETIME_TABLE}_osi;")
+                    return
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (self.LIFETIME_TABLE,))
+            if cur.fetchone() is None:
+                return
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{self.LIFETIME_TABLE}_osi_ts "
+                f"ON {self.LIFETIME_TABLE}(osiKey, timestamp);"
+            )
+            cur.execute(f"DROP INDEX IF EXISTS idx_{self.LIFETIME_TABLE}_osi;")
+            logger.logMessage(f"[Permutation] Created idx_{self.LIFETIME_TABLE}_osi_ts.")
+        except sqlite3.OperationalError as e:
+            logger.logMessage(f"[Permutation] Could not ensure lifetime index: {e}")
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _build_source_sql(self):
+        """Temp-table statements holding one OSI's rows keyed by rn, parsed and cast once."""
+        passthrough_cols = [c for c in self.snapshot_columns if c not in _RESERVED_COLUMNS]
+        cast_cols = [c for c in self.numeric_columns if c not in _RESERVED_COLUMNS]
+        if "lastPrice" in self.snapshot_columns and "lastPrice" not in cast_cols:
+            cast_cols.append("lastPrice")
+        self._passthrough_cols = passthrough_cols
+        self._cast_cols = cast_cols
+
+        # temp tables live per connection (ours or the shared writer's); the name
+        # carries the layout so a changed lifetime schema never reuses a stale one
+        src_cols = ["rn", "jd", "es", "osiKey", "timestamp"] + passthrough_cols + [f"n_{c}" for c in cast_cols]
+        layout = hashlib.sha256(repr(src_cols).encode()).hexdigest()[:12]
+        self._src_table = f"perm_src_{layout}"
+
+        col_defs = ",\n                ".join(["rn INTEGER PRIMARY KEY", "jd REAL", "es REAL"] + src_cols[3:])
+        self._create_src_sql = f"""
+            CREATE TEMP TABLE IF NOT EXISTS {self._src_table} (
+                {col_defs}
+            );
+        """
+        self._index_src_sql = (
+            f"CREATE INDEX IF NOT EXISTS temp.{self._src_table}_jd ON {self._src_table}(jd);"
+        )
+        self._clear_src_sql = f"DELETE FROM temp.{self._src_table};"
+        # sampled (i, j) rn pairs when a seeded or windowed OSI is capped
+        self._pairs_table = f"{self._src_table}_pairs"
+        self._create_pairs_sql = f"CREATE TEMP TABLE IF NOT EXISTS {self._pairs_table} (i INTEGER, j INTEGER);"
+        self._clear_pairs_sql = f"DELETE FROM temp.{self._pairs_table};"
+        self._fill_pairs_sql = f"INSERT INTO temp.{self._pairs_table} (i, j) VALUES (?, ?);"
+        select_cols = ",\n                       ".join(
+            ["osiKey", "timestamp"] + passthrough_cols + [f"{_num(c)} AS n_{c}" for c in cast_cols]
+        )
+        # es: epoch seconds to the microsecond (julianday stops at ms). Whole seconds
+        # come from jd, the fraction from the text; integer microseconds / 1e6 rounds
+        # the same as datetime.timestamp()
+        us = "CAST(ROUND(CAST('0' || fs AS REAL) * 1000000.0) AS INTEGER)"
+        es = f"(CAST(ROUND((jd - 2440587.5) * 86400.0 - {us} / 1000000.0) AS INTEGER) * 1000000 + {us}) / 1000000.0"
+        self._fill_src_sql = f"""
+            INSERT INTO temp.{self._src_table} ({', '.join(src_cols)})
+            SELECT rn, jd, {es} AS es, {', '.join(src_cols[3:])} FROM (
+                SELECT ROW_NUMBER() OVER (ORDER BY timestamp) - 1 AS rn,
+                       julianday(timestamp) AS jd,
+                       CASE WHEN substr(timestamp, 20, 1) = '.' THEN substr(timestamp, 20) ELSE '' END AS fs,
+                       {select_cols}
+                FROM {self.LIFETIME_TABLE}
+                WHERE osiKey = :osi
+            )
+            WHERE rn % :stride = 0;
+        """
+
+    def _build_insert_select_sql(self, sampled: bool = False) -> str:
+        """INSERT ... SELECT of the OSI's (buy, sell) pairs, or only the sampled ones."""
+        passthrough_cols, delta_cols = self._passthrough_cols, [
+            c for c in self.numeric_columns if c not in _RESERVED_COLUMNS
+        ]
+        if "lastPrice" in self.snapshot_columns:
+            buy_price, sell_price = "a.n_lastPrice", "b.n_lastPrice"
+        else:
+            buy_price = sell_price = "0.0"
+
+        exprs = ["a.osiKey", "a.timestamp", "b.timestamp"]
+        for col in passthrough_cols:
+            exprs += [f"a.{col}", f"b.{col}"]
+        exprs += [f"b.n_{col} - a.n_{col}" for col in delta_cols]
+        hold_expr = "(b.es - a.es)"
+        exprs += [
+            f"IFNULL({hold_expr}, 0.0)",
+            f"{sell_price} - {buy_price}",
+            f"CASE WHEN {buy_price} != 0 THEN ({sell_price} - {buy_price}) / {buy_price} ELSE 0.0 END",
+        ]
+        select_sql = ",\n                   ".join(exprs)
+
+        where = []
+        if self.max_hold_seconds is not None:
+            where.append(f"{hold_expr} <= :max_hold")
+        if sampled:
+            # sampled pairs already lie inside the windows; only the exact hold test remains
+            return f"""
+            INSERT INTO {self.PERM_TABLE} ({', '.join(self._insert_columns)})
+            SELECT {select_sql}
+            FROM temp.{self._pairs_table} p
+            JOIN temp.{self._src_table} a ON a.rn = p.i
+            JOIN temp.{self._src_table} b ON b.rn = p.j
+            WHERE {' AND '.join(where) or '1'}
+            ON CONFLICT(osiKey, buy_timestamp, sell_timestamp) DO NOTHING;
+        """
+
+        if self.max_pair_gap is not None:
+            join_on = ["b.rn BETWEEN a.rn + 1 AND a.rn + :max_gap"]
+        elif self.max_hold_seconds is not None:
+            # unary + keeps the planner on the (bounded) jd range below instead of
+            # the open-ended rowid range
+            join_on = ["+b.rn > a.rn"]
+        else:
+            join_on = ["b.rn > a.rn"]
+        if self.max_hold_seconds is not None:
+            # forward window in time (jd, ms resolution); the exact es test stays in WHERE
+            join_on.append("b.jd BETWEEN a.jd AND a.jd + :max_hold_days")
+
+        # a WHERE is required so SQLite parses the trailing ON CONFLICT as an upsert
+        return f"""
+            INSERT INTO {self.PERM_TABLE} ({', '.join(self._insert_columns)})
+            SELECT {select_sql}
+            FROM temp.{self._src_table} a
+            JOIN temp.{self._src_table} b ON {' AND '.join(join_on)}
+            WHERE {' AND '.join(where) or '1'}
+            ON CONFLICT(osiKey, buy_timestamp, sell_timestamp) DO NOTHING;
+        """
+
     # -------------------------
     # lifecycle
     # -------------------------
@@ -201,25 +482,39 @@ class OptionPermutationProcessor:
             logger.logMessage("[Permutation] Processor already running.")
             return
         self.running = True
+        self._stop_event.clear()
+        with self._write_lock:
+            self._open_loop_conns()
         self.thread = threading.Thread(target=self._loop, daemon=True, name="OptionPermutationProcessor")
         self.thread.start()
         logger.logMessage("[Permutation] Processor started.")
 
+    def wake(self):
+        """Start the next pass now instead of after check_interval; safe from any thread."""
+        self._wake.set()
+
     def stop(self):
         self.running = False
+        self._stop_event.set()
+        self._wake.set()
         if self.thread:
             self.thread.join(timeout=10)
+        # a loop thread still finishing its current OSI closes the connections itself
+        if self.thread is None or not self.thread.is_alive():
+            with self._write_lock:
+                self._close_loop_conns()
         logger.logMessage("[Permutation] Processor stopped.")
 
     def get_status(self) -> Dict:
-        return {
-            "total_rows_inserted": int(self._total_rows_inserted),
-            "total_osis_processed": int(self._total_osis_processed),
-            "last_run": self._last_run.isoformat() if self._last_run else None,
-            "last_error": str(self._last_error) if self._last_error else None,
-            "last_vacuum": self._last_vacuum.isoformat() if self._last_vacuum else None,
-            "commit_count": int(self._commit_count)
-        }
+        with self._status_lock:
+            return {
+                "total_rows_inserted": int(self._total_rows_inserted),
+                "total_osis_processed": int(self._total_osis_processed),
+                "last_run": self._last_run.isoformat() if self._last_run else None,
+                "last_error": str(self._last_error) if self._last_error else None,
+                "last_vacuum": self._last_vacuum.isoformat() if self._last_vacuum else None,
+                "commit_count": int(self._commit_count)
+            }
 
     # -------------------------
     # main loop
@@ -228,188 +523,350 @@ class OptionPermutationProcessor:
         while self.running:
             try:
                 self._last_run = datetime.utcnow()
-                self._process_batch()
+                idle = self._process_pending()
+                self._run_maintenance(idle)
             except Exception as e:
                 self._last_error = str(e)
                 logger.logMessage(f"[Permutation] Loop error: {e}")
-            time.sleep(self.check_interval)
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+        with self._write_lock:
+            self._close_loop_conns()
 
     # -------------------------
     # fetch & process batches
     # -------------------------
-    def _fetch_osi_batch(self, conn) -> List[str]:
+    def _process_pending(self) -> bool:
+        """
+        Drain every OSI currently in the lifetime table, one batch at a time.
+        Keyset pagination (osiKey > last seen) walks the osiKey index once per cycle;
+        each page is a short statement, so no read snapshot is held across commits,
+        and OSIs that failed earlier in the cycle are not picked up again.
+        Returns True once nothing is left to process (i.e. the processor is idle).
+        """
+        after = ""
+        while self.running:
+            last = self._process_batch(after)
+            if last is None:
+                return True
+            after = last
+        return False
+
+    def _fetch_osi_batch(self, conn, after: str = "") -> List[Tuple[str, int]]:
+        """Next batch of (osiKey, snapshot count) after `after`, read outside the write transaction."""
         cur = conn.cursor()
-        cur.execute(f"SELECT DISTINCT osiKey FROM {self.LIFETIME_TABLE} LIMIT ?;", (self.batch_commit_size,))
-        return [r[0] for r in cur.fetchall()]
-
-    def _process_batch(self):
-        conn = None
-        try:
-            conn = self._get_conn()
-            conn.row_factory = sqlite3.Row
-            osi_batch = self._fetch_osi_batch(conn)
+        cur.execute(self._fetch_batch_sql, (after, self.batch_commit_size))
+        return cur.fetchall()
+
+    def _process_batch(self, after: str = "") -> Optional[str]:
+        """Process one batch of OSIs; returns the last osiKey seen, or None when nothing is left."""
+        with self._write_lock:
+            conn = self._writer_conn
+            if conn is None:
+                return None
+            osi_batch = self._fetch_osi_batch(self._reader_conn, after)
             if not osi_batch:
-                return
+                return None
+
+            if self.writer is not None:
+                rows_inserted, osis_done = self._submit_batch(osi_batch)
+            else:
+                rows_inserted, osis_done = self._commit_batch(conn, osi_batch)
 
-            for osi in osi_batch:
+            with self._status_lock:
+                self._total_rows_inserted += rows_inserted
+                self._total_osis_processed += osis_done
+                self._commit_count += 1
+                commit_count = self._commit_count
+            # ANALYZE rarely and only the table we write to; a full-DB ANALYZE
+            # rescans every index and can cost more than the insert itself.
+            if (commit_count % self.analyze_after_commits) == 0 and \
+                    time.monotonic() - self._last_analyze_mono > DEFAULT_ANALYZE_MIN_INTERVAL.total_seconds():
+                self._analyze_due = True
+
+            return osi_batch[-1][0]
+
+    def _commit_batch(self, conn: sqlite3.Connection, osi_batch: List[Tuple[str, int]]) -> Tuple[int, int]:
+        """Apply a batch on our own writer connection; returns (rows inserted, OSIs done)."""
+        # one transaction (one fsync) for the whole batch; a savepoint per OSI
+        # lets a single bad OSI roll back without losing the rest
+        self._begin_with_retries(conn)
+        rows_inserted = 0
+        osis_done = 0
+        try:
+            for osi, n in osi_batch:
+                if self._stop_event.is_set():
+                    break  # commit what is done; the rest stays for the next run
+                conn.execute("SAVEPOINT osi;")
                 try:
-                    self._process_single_osi(osi)
-                    self._total_osis_processed += 1
+                    rows_inserted += self._process_single_osi(conn, osi, n)
+                    conn.execute("RELEASE osi;")
+                    osis_done += 1
                 except Exception as e:
+                    conn.execute("ROLLBACK TO osi;")
+                    conn.execute("RELEASE osi;")
                     self._last_error = str(e)
                     logger.logMessage(f"[Permutation] Error processing OSI={osi}: {e}")
-        finally:
-            if conn:
+            conn.execute("COMMIT;")
+        except Exception:
+            # only roll back if the batch transaction is still open
+            if conn.in_transaction:
                 try:
-                    conn.close()
+                    conn.execute("ROLLBACK;")
                 except Exception:
                     pass
-
-    def _process_single_osi(self, osi: str):
-        # Use a fresh connection for the entire per-OSI work
-        conn = self._get_conn()
-        try:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(f"SELECT * FROM {self.LIFETIME_TABLE} WHERE osiKey = ? ORDER BY timestamp ASC;", (osi,))
-            raw_snaps = cur.fetchall()
-            snaps = [dict(r) for r in raw_snaps]
-
-            if len(snaps) < 2:
-                # nothing useful — remove to keep DB clean in short transaction
-                try:
-                    conn.execute("BEGIN IMMEDIATE;")
-                    cur.execute(f"DELETE FROM {self.LIFETIME_TABLE} WHERE osiKey = ?;", (osi,))
-                    conn.execute("COMMIT;")
-                except Exception:
-                    try:
-                        conn.execute("ROLLBACK;")
-                    except Exception:
-                        pass
-                return
-
-            rows_to_insert: List[Dict] = []
-            for i in range(len(snaps) - 1):
-                buy = snaps[i]
-                for j in range(i + 1, len(snaps)):
-                    sell = snaps[j]
-                    rows_to_insert.append(self._build_perm_row(osi, buy, sell))
-
-            if rows_to_insert:
-                self._insert_with_retries(conn, rows_to_insert)
-
-            # delete consumed lifetimes
-            try:
-                conn.execute("BEGIN IMMEDIATE;")
-                cur.execute(f"DELETE FROM {self.LIFETIME_TABLE} WHERE osiKey = ?;", (osi,))
-                conn.execute("COMMIT;")
-            except Exception:
+            raise
+        return rows_inserted, osis_done
+
+    def _submit_batch(self, osi_batch: List[Tuple[str, int]]) -> Tuple[int, int]:
+        """
+        Hand each OSI to the shared SqliteWriter as one unit (insert + delete commit
+        together, in a transaction of their own) and wait for all of them.
+        """
+        pending = []
+        deadline = time.monotonic() + DEFAULT_RESULT_TIMEOUT
+        sampled: Optional[Future] = None
+        for osi, n in osi_batch:
+            if self._stop_event.is_set():
+                break
+            ops = self._osi_ops(osi, n)
+            # a sampled unit carries its whole pair list: build the next one while
+            # the writer runs the last, but never queue more than one
+            is_sampled = any(sql is self._fill_pairs_sql for sql, _ in ops)
+            if is_sampled and sampled is not None:
                 try:
-                    conn.execute("ROLLBACK;")
+                    self._await_unit(sampled, deadline)
                 except Exception:
-                    pass
-
-        finally:
+                    pass  # reported with its OSI below
+                if self._stop_event.is_set():
+                    break
+            fut = self.writer.submit_unit(ops, exclusive=True)
+            if is_sampled:
+                sampled = fut
+            pending.append((osi, self._insert_positions(ops), ops[-1:], fut))
+        rows_inserted = 0
+        osis_done = 0
+        for osi, positions, delete_op, fut in pending:
             try:
-                conn.close()
-            except Exception:
-                pass
-
-    def _build_perm_row(self, osi: str, buy_row: Dict, sell_row: Dict) -> Dict:
-        buy_ts = buy_row.get("timestamp")
-        sell_ts = sell_row.get("timestamp")
-        try:
-            dt_buy = datetime.fromisoformat(buy_ts)
-            dt_sell = datetime.fromisoformat(sell_ts)
-            hold_seconds = (dt_sell - dt_buy).total_seconds()
-        except Exception:
-            hold_seconds = 0.0
-
-        def _to_float(v):
-            try:
-                return float(v) if v is not None else 0.0
-            except Exception:
-                return 0.0
-
-        buy_price = _to_float(buy_row.get("lastPrice", 0.0))
-        sell_price = _to_float(sell_row.get("lastPrice", 0.0))
-        profit = sell_price - buy_price
-        return_pct = profit / buy_price if buy_price else 0.0
-
-        row: Dict = {
-            "osiKey": osi,
-            "buy_timestamp": buy_ts,
-            "sell_timestamp": sell_ts,
-            "hold_seconds": hold_seconds,
-            "profit": profit,
-            "return_pct": return_pct,
-        }
-
-        for col, _ in self.snapshot_schema:
-            if col in _RESERVED_COLUMNS:
-                continue
-            row[f"buy_{col}"] = buy_row.get(col)
-            row[f"sell_{col}"] = sell_row.get(col)
-
-        for col in self.numeric_columns:
-            if col in _RESERVED_COLUMNS:
-                continue
-            b = _to_float(buy_row.get(col))
-            s = _to_float(sell_row.get(col))
+                counts = self._await_unit(fut, deadline)
+                self._check_kept(osi, delete_op, counts)
+                rows_inserted += sum(counts[k] for k in positions)
+                osis_done += 1
+            except Exception as e:
+                fut.cancel()  # not started yet: drop it; its lifetimes stay for the next pass
+                self._last_error = str(e) or type(e).__name__
+                logger.logMessage(f"[Permutation] Error processing OSI={osi}: {e!r}")
+        return rows_inserted, osis_done
+
+    def _await_unit(self, fut: Future, deadline: float) -> List[int]:
+        # poll so stop() can cut the wait short; give up at the deadline either way
+        while True:
             try:
-                row[f"delta_{col}"] = float(s) - float(b)
-            except Exception:
-                row[f"delta_{col}"] = None
-
-        return row
-
-    def _insert_with_retries(self, conn: sqlite3.Connection, rows: List[Dict]):
-        if not rows:
-            return
-
-        columns = list(rows[0].keys())
-        placeholders = ",".join(["?"] * len(columns))
-        sql = f"INSERT OR REPLACE INTO {self.PERM_TABLE} ({','.join(columns)}) VALUES ({placeholders});"
-        values = [tuple(row.get(c) for c in columns) for row in rows]
-
+                return fut.result(timeout=0 if self._stop_event.is_set() else 0.5)
+            except FutureTimeout:
+                if self._stop_event.is_set() or time.monotonic() >= deadline:
+                    raise
+
+    def _osi_ops(self, osi: str, n: int) -> List[Tuple[str, object]]:
+        """Statements that expand one OSI (n snapshots) into permutations and delete its lifetimes."""
+        ops: List[Tuple[str, object]] = []
+        capped = False
+        # fewer than 2 snapshots has nothing to pair — just remove below
+        if n >= 2:
+            bounds = self._pair_upper_bounds(osi, n)
+            total_pairs = self._windowed_pair_count(n, bounds)
+            params = {
+                "osi": osi,
+                "stride": 1,
+                "max_gap": self.max_pair_gap,
+                "max_hold": self.max_hold_seconds,
+                # superset of the exact hold test, for the jd range seek
+                "max_hold_days": (self.max_hold_seconds + _JD_SLACK_SECONDS) / 86400.0
+                if self.max_hold_seconds is not None else None,
+            }
+            sample = None
+            if total_pairs > self.max_pairs_per_osi:
+                capped = True
+                if self.pair_sample_seed is None and bounds is None:
+                    params["stride"] = self._downsample_stride(osi, n, total_pairs)
+                else:
+                    # a stride would space rows past a gap/hold window; sample inside it instead
+                    sample = self._sample_pairs(osi, n, bounds, total_pairs)
+            ops.append((self._create_src_sql, ()))
+            if sample is not None:
+                ops += [
+                    (self._create_pairs_sql, ()),
+                    (self._clear_pairs_sql, ()),
+                    (self._fill_pairs_sql, sample),  # list -> executemany
+                ]
+            elif self.max_hold_seconds is not None:
+                ops.append((self._index_src_sql, ()))
+            ops += [
+                (self._clear_src_sql, ()),
+                (self._fill_src_sql, params),
+                (self._insert_sql if sample is None else self._insert_sampled_sql, params),
+            ]
+        # delete consumed lifetimes; a capped OSI keeps them unless it produced permutations
+        if capped:
+            ops.append((self._delete_capped_lifetimes_sql, (osi, osi)))
+        else:
+            ops.append((self._delete_lifetimes_sql, (osi,)))
+        return ops
+
+    def _check_kept(self, osi: str, ops: List[Tuple[str, object]], counts: List[int]):
+        if ops[-1][0] is self._delete_capped_lifetimes_sql and counts[-1] == 0:
+            logger.logMessage(
+                f"[Permutation] OSI={osi} produced no permutations after capping; lifetimes kept."
+            )
+
+    def _insert_positions(self, ops: List[Tuple[str, object]]) -> List[int]:
+        return [k for k, (sql, _) in enumerate(ops)
+                if sql is self._insert_sql or sql is self._insert_sampled_sql]
+
+    def _process_single_osi(self, conn: sqlite3.Connection, osi: str, n: int) -> int:
+        """Run one OSI's statements inside the batch transaction; returns rows inserted."""
+        cur = conn.cursor()
+        ops = self._osi_ops(osi, n)
+        counts = []
+        for sql, params in ops:
+            if isinstance(params, list):
+                cur.executemany(sql, params)
+            else:
+                cur.execute(sql, params)
+            counts.append(max(cur.rowcount, 0))
+        self._check_kept(osi, ops, counts)
+        return sum(counts[k] for k in self._insert_positions(ops))
+
+    def _pair_upper_bounds(self, osi: str, n: int) -> Optional[List[int]]:
+        """
+        For each snapshot i (rn order), one past the last j it may pair with under
+        max_pair_gap / max_hold_seconds; None when neither window is set.
+        """
+        if self.max_pair_gap is None and self.max_hold_seconds is None:
+            return None
+        if self.max_pair_gap is not None:
+            bounds = [min(n, i + 1 + self.max_pair_gap) for i in range(n)]
+        else:
+            bounds = [n] * n
+        if self.max_hold_seconds is not None:
+            rows = self._reader_conn.execute(self._fetch_jd_sql, (osi,)).fetchall()
+            # unparseable timestamps (NULL jd) never pass the hold test
+            jds = [r[0] if r[0] is not None else math.inf for r in rows][:n]
+            limit = (self.max_hold_seconds + _JD_SLACK_SECONDS) / 86400.0
+            for i, jd in enumerate(jds):
+                hi = i + 1 if jd == math.inf else bisect.bisect_right(jds, jd + limit, lo=i + 1)
+                bounds[i] = min(bounds[i], hi)
+        return bounds
+
+    @staticmethod
+    def _windowed_pair_count(n: int, bounds: Optional[List[int]]) -> int:
+        # pairs the join would produce before any cap: N*(N-1)/2, or fewer in a window
+        if bounds is None:
+            return n * (n - 1) // 2
+        return sum(max(0, hi - i - 1) for i, hi in enumerate(bounds))
+
+    def _downsample_stride(self, osi: str, n: int, total_pairs: int) -> int:
+        # downsample long lifetimes so a single OSI can't blow up the table or hold
+        # the writer for hours; a stride s cuts pairs by ~s^2 (unwindowed OSIs only)
+        if total_pairs <= self.max_pairs_per_osi:
+            return 1
+        stride = math.ceil(math.sqrt(2 * total_pairs / self.max_pairs_per_osi))
+        logger.logMessage(
+            f"[Permutation] OSI={osi} has {n} snapshots ({total_pairs} pairs); "
+            f"downsampled with stride={stride} to {math.ceil(n / stride)} snapshots."
+        )
+        return stride
+
+    def _sample_pairs(self, osi: str, n: int, bounds: Optional[List[int]], total_pairs: int) -> List[Tuple[int, int]]:
+        """
+        Draw max_pairs_per_osi distinct (i, j) rn pairs uniformly from the OSI's
+        (windowed) pairs, reproducibly from pair_sample_seed (or 0) and the OSI key. Pairs
+        are numbered row by row (i, then j); sorted draws map back with one walk.
+        Costs O(N + k) here and k rowid lookups in SQLite, not an N^2 scan.
+        """
+        if bounds is None:
+            bounds = [n] * n
+        seed = self.pair_sample_seed if self.pair_sample_seed is not None else 0
+        rng = random.Random(f"{seed}:{osi}")
+        picks = sorted(rng.sample(range(total_pairs), self.max_pairs_per_osi))
+        pairs: List[Tuple[int, int]] = []
+        i, row_start, row_len = 0, 0, max(0, bounds[0] - 1)
+        for k in picks:
+            while k >= row_start + row_len:
+                row_start += row_len
+                i += 1
+                row_len = max(0, bounds[i] - i - 1)
+            pairs.append((i, i + 1 + k - row_start))
+        logger.logMessage(
+            f"[Permutation] OSI={osi} has {n} snapshots ({total_pairs} pairs); "
+            f"sampled {len(pairs)} pairs (seed={seed})."
+        )
+        return pairs
+
+    def _begin_with_retries(self, conn: sqlite3.Connection):
         attempt = 0
         while attempt < self.insert_retries:
             try:
                 # Acquire write reservation early to avoid mid-commit failures
                 conn.execute("BEGIN IMMEDIATE;")
-                conn.executemany(sql, values)
-                conn.execute("COMMIT;")
-                self._total_rows_inserted += len(values)
-                self._commit_count += 1
-
-                # ANALYZE occasionally (cheap)
-                if (self._commit_count % self.analyze_after_commits) == 0:
-                    try:
-                        conn.execute("ANALYZE;")
-                    except Exception:
-                        pass
-
-                # NOTE: VACUUM is intentionally removed from normal path.
-                # If you need VACUUM, run it from a maintenance script while server is down.
-
                 return
             except sqlite3.OperationalError as e:
-                try:
-                    conn.execute("ROLLBACK;")
-                except Exception:
-                    pass
+                if not is_busy_error(e):
+                    raise
                 attempt += 1
-                sleep_time = DEFAULT_INSERT_RETRY_BACKOFF * attempt
+                sleep_time = min(DEFAULT_INSERT_RETRY_BACKOFF_CAP, DEFAULT_INSERT_RETRY_BACKOFF * 2 ** attempt) \
+                    + random.uniform(0, DEFAULT_INSERT_RETRY_BACKOFF)
                 logger.logMessage(f"[Permutation] SQLite OperationalError (attempt {attempt}) in thread={threading.current_thread().name}: {e}; retrying in {sleep_time:.2f}s")
                 time.sleep(sleep_time)
-            except Exception as e:
-                try:
-                    conn.execute("ROLLBACK;")
-                except Exception:
-                    pass
-                self._last_error = str(e)
-                logger.logMessage(f"[Permutation] Unexpected insert error: {e}")
-                raise
 
         # If we fell out of loop, raise
-        raise RuntimeError("Failed to insert permutation rows after retries.")
+        raise RuntimeError("Failed to begin permutation batch transaction after retries.")
+
+    # -------------------------
+    # maintenance (between batches)
+    # -------------------------
+    def _run_maintenance(self, idle: bool = False):
+        if self._analyze_due:
+            with self._write_lock:
+                if self._writer_conn is not None:
+                    try:
+                        self._writer_conn.execute(f"ANALYZE {self.PERM_TABLE};")
+                        self._last_analyze_mono = time.monotonic()
+                    except Exception as e:
+                        logger.logMessage(f"[Permutation] ANALYZE failed: {e}")
+            self._analyze_due = False
+
+        # space reclamation only once the backlog is drained, never mid-ingest
+        if idle and time.monotonic() >= self._vacuum_due_mono:
+            self._maybe_vacuum()
+
+    def _maybe_vacuum(self):
+        """
+        With auto_vacuum=INCREMENTAL, hand back a bounded number of free pages on
+        the writer connection. Otherwise there is nothing safe to do online.
+        """
+        try:
+            mode = self._reader_conn.execute("PRAGMA auto_vacuum;").fetchall()[0][0]
+        except Exception as e:
+            logger.logMessage(f"[Permutation] Could not read auto_vacuum mode: {e}")
+            return
+        if mode == 2:  # INCREMENTAL
+            with self._write_lock:
+                if self._writer_conn is None:
+                    return
+                try:
+                    # each sqlite3_step frees one page and execute() stops after the
+                    # first; executescript steps the pragma through to completion
+                    self._writer_conn.executescript(
+                        f"PRAGMA incremental_vacuum({DEFAULT_INCREMENTAL_VACUUM_PAGES});"
+                    )
+                    self._last_vacuum = datetime.utcnow()
+                    self._vacuum_due_mono = time.monotonic() + self.vacuum_interval.total_seconds()
+                    logger.logMessage("[Permutation] Incremental vacuum complete.")
+                except sqlite3.OperationalError as e:
+                    logger.logMessage(f"[Permutation] Incremental vacuum skipped: {e}")
+        else:
+            # NOTE: full VACUUM is intentionally not run here; it holds the write lock
+            # for the whole rewrite. Run it from a maintenance script while the server
+            # is down (PRAGMA auto_vacuum=INCREMENTAL; VACUUM; enables this path).
+            self._vacuum_due_mono = time.monotonic() + self.vacuum_interval.total_seconds()
@@ -1,22 +1,40 @@
 # processors/snapshot_processor.py
 """
 OptionSnapshotProcessor
-- Watches a folder for JSON snapshot files and ingests them into option_snapshots.
-- Uses short-lived DB connections with WAL and busy_timeout to reduce lock contention.
-- Inserts per-file are run inside a single short transaction (BEGIN IMMEDIATE).
+- Watches a folder for JSON snapshot files and ingests them into option_snapshots
+  (watchdog close/move events when installed, plus a periodic glob sweep).
+- Reuses one DB connection per thread (WAL, busy_timeout) so pragmas and page cache persist across files.
+- Inserts per-file are run inside a single short transaction (BEGIN IMMEDIATE), or handed
+  to a shared SqliteWriter as one unit when one is configured.
 """
 
 import json
+import queue
 import sqlite3
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Union, Optional
+from typing import Callable, Union, Optional, List
 
 from shared_options.log.logger_singleton import getLogger
 from logging import FileHandler
 
+from processors.sqlite_writer import DEFAULT_RESULT_TIMEOUT, SqliteWriter
+
+try:
+    import orjson  # optional: C parser, several times faster than json on large files
+except ImportError:
+    orjson = None
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional: fall back to polling the folder
+    FileSystemEventHandler = object
+    Observer = None
+
 logger = getLogger()
 
 # resolve log file for context (used by old code; kept for compatibility)
@@ -26,6 +44,47 @@ for handler in logger.logger.handlers:
         LOG_FILE = Path(handler.baseFilename)
         break
 
+DEFAULT_PARSE_WORKERS = 4
+
+# fixed snapshot layout; the INSERT is built once so every file reuses the
+# same statement from sqlite3's per-connection cache
+SNAPSHOT_COLUMNS = (
+    "osiKey", "timestamp", "symbol", "optionType", "strikePrice",
+    "lastPrice", "bid", "ask", "bidSize", "askSize", "volume", "openInterest",
+    "nearPrice", "inTheMoney", "delta", "gamma", "theta", "vega", "rho", "iv",
+    "daysToExpiration", "spread", "midPrice", "moneyness"
+)
+INSERT_SNAPSHOT_SQL = (
+    f"INSERT OR REPLACE INTO option_snapshots ({', '.join(SNAPSHOT_COLUMNS)}) "
+    f"VALUES ({', '.join(['?'] * len(SNAPSHOT_COLUMNS))});"
+)
+
+
+class _JsonArrivalHandler(FileSystemEventHandler):
+    """
+    Queues *.json files once they are complete: closed after writing (uploads
+    write in place) or renamed within the folder. Creation events are ignored
+    because the file may still be half-written; files moved in from elsewhere
+    (reported as creations) are left to the periodic sweep.
+    """
+
+    def __init__(self, q: "queue.Queue[Optional[Path]]"):
+        super().__init__()
+        self._queue = q
+
+    def _offer(self, path) -> None:
+        path = Path(path if isinstance(path, str) else path.decode())
+        if path.suffix == ".json":
+            self._queue.put(path)
+
+    def on_closed(self, event) -> None:
+        if not event.is_directory:
+            self._offer(event.src_path)
+
+    def on_moved(self, event) -> None:
+        if not event.is_directory:
+            self._offer(event.dest_path)
+
 
 class OptionSnapshotProcessor(threading.Thread):
     def __init__(
@@ -33,15 +92,30 @@ class OptionSnapshotProcessor(threading.Thread):
         db_path: Union[str, Path],
         incoming_folder: Union[str, Path],
         check_interval: int = 30,
-        sqlite_timeout: float = 30.0
+        sqlite_timeout: float = 30.0,
+        writer: Optional[SqliteWriter] = None,
+        parse_workers: int = DEFAULT_PARSE_WORKERS,
+        on_ingested: Optional[Callable[[], None]] = None
     ):
         super().__init__(daemon=True, name="OptionSnapshotProcessor")
         self.db_path = Path(db_path)
         self.folder = Path(incoming_folder)
         self.check_interval = int(check_interval)
         self.sqlite_timeout = float(sqlite_timeout)
+        # optional shared writer thread; when set, inserts go through its queue
+        self.writer = writer
+        self.parse_workers = max(1, int(parse_workers))
+        # called after a pass commits new snapshots, e.g. OptionLifetimeProcessor.wake
+        self.on_ingested = on_ingested
 
         self._stop_event = threading.Event()
+        # file arrivals from watchdog; None is the wake-up sentinel used by stop()
+        self._arrivals: "queue.Queue[Optional[Path]]" = queue.Queue()
+        # the folder is also swept every check_interval, even while events keep coming
+        self._next_sweep = time.monotonic() + self.check_interval
+        # per-thread connection: the run loop (or any caller of ingest_file) keeps
+        # its own, since sqlite3 connections are bound to their creating thread
+        self._tls = threading.local()
 
         # ensure necessary paths exist
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
@@ -51,19 +125,41 @@ class OptionSnapshotProcessor(threading.Thread):
         self._init_db()
 
     # -------------------------
-    # DB helper (short-lived connections)
+    # DB helper (one long-lived connection per thread)
     # -------------------------
     def _get_conn(self) -> sqlite3.Connection:
         conn = sqlite3.connect(str(self.db_path), timeout=self.sqlite_timeout, isolation_level=None)
         try:
+            # only a fresh file picks this up; existing DBs keep their mode until a VACUUM
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
             conn.execute("PRAGMA journal_mode=WAL;")
             conn.execute("PRAGMA synchronous=NORMAL;")
             conn.execute("PRAGMA busy_timeout=30000;")  # 30 seconds
+            # bulk writes: big page cache, mmap reads, in-memory temp b-trees
+            conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
+            conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+            conn.execute("PRAGMA temp_store=MEMORY;")
         except Exception:
             # ignore on constrained builds
             pass
         return conn
 
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._tls, "conn", None)
+        if conn is None:
+            conn = self._get_conn()
+            self._tls.conn = conn
+        return conn
+
+    def _close_conn(self) -> None:
+        conn = getattr(self._tls, "conn", None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._tls.conn = None
+
     # -------------------------
     # Table init
     # -------------------------
@@ -114,64 +210,142 @@ class OptionSnapshotProcessor(threading.Thread):
     # -------------------------
     def stop(self):
         self._stop_event.set()
+        self._arrivals.put(None)
+
+    def _start_observer(self):
+        if Observer is None:
+            logger.logMessage("[SnapshotProcessor] watchdog not installed; polling every "
+                              f"{self.check_interval}s")
+            return None
+        try:
+            observer = Observer()
+            observer.schedule(_JsonArrivalHandler(self._arrivals), str(self.folder), recursive=False)
+            observer.daemon = True
+            observer.start()
+            return observer
+        except Exception as e:
+            logger.logMessage(f"[SnapshotProcessor] watchdog unavailable ({e}); polling")
+            return None
+
+    def _wait_for_files(self) -> List[Path]:
+        """
+        Block until watchdog reports files (or the next sweep is due), then drain
+        everything queued. Every check_interval the folder is also swept, whether or
+        not events arrived: that picks up files moved in from elsewhere, events
+        watchdog missed, files kept after a failed write, and is the whole mechanism
+        when watchdog is not installed.
+        """
+        files: List[Optional[Path]] = []
+        timeout = self._next_sweep - time.monotonic()
+        if timeout > 0:
+            try:
+                files.append(self._arrivals.get(timeout=timeout))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                files.append(self._arrivals.get_nowait())
+            except queue.Empty:
+                break
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + self.check_interval
+            files.extend(sorted(self.folder.glob("*.json")))
+        return list(dict.fromkeys(f for f in files if f is not None))
 
     def run(self):
         logger.logMessage("[SnapshotProcessor] Started")
+        observer = self._start_observer()
+        # parsing is read + decode work that can overlap the previous file's write;
+        # writes themselves stay serialized on this thread (or the shared writer)
+        pool = ThreadPoolExecutor(max_workers=self.parse_workers, thread_name_prefix="SnapshotParse") \
+            if self.parse_workers > 1 else None
+        files = sorted(self.folder.glob("*.json"))  # backlog present at startup
         while not self._stop_event.is_set():
             try:
-                for file in list(self.folder.glob("*.json")):
-                    try:
-                        logger.logMessage(f"[SnapshotProcessor] Processing {file.name}")
-                        self.ingest_file(file)
-                        try:
-                            file.unlink(missing_ok=True)
-                        except Exception:
-                            logger.logMessage(f"[SnapshotProcessor] Failed to unlink {file.name}")
-                    except Exception as e:
-                        logger.logMessage(f"[SnapshotProcessor] Error processing {file.name}: {e}")
-                time.sleep(self.check_interval)
+                if self._ingest_files(files, pool) and self.on_ingested is not None:
+                    self.on_ingested()
+                files = self._wait_for_files()
             except Exception as e:
                 logger.logMessage("[SnapshotProcessor] Loop crash (recovering)")
                 logger.logMessage(str(e))
+                files = []
                 time.sleep(5)
+        if observer is not None:
+            observer.stop()
+            observer.join(timeout=5)
+        if pool is not None:
+            pool.shutdown(wait=True)
+        self._close_conn()
         logger.logMessage("[SnapshotProcessor] Stopped")
 
+    def _ingest_files(self, files: List[Path], pool: Optional[ThreadPoolExecutor]) -> int:
+        """Parse ahead and write each file; returns how many files were committed."""
+        written = 0
+        files = [f for f in files if f.exists()]  # may be gone already (event + sweep both saw it)
+        # parse at most a couple of files per worker ahead of the writes to bound memory
+        chunk = max(1, self.parse_workers * 2)
+        for start in range(0, len(files), chunk):
+            batch = files[start:start + chunk]
+            parsed = pool.map(self._parse_file, batch) if pool is not None else map(self._parse_file, batch)
+            for file, rows in zip(batch, parsed):
+                if self._stop_event.is_set():
+                    return written
+                try:
+                    logger.logMessage(f"[SnapshotProcessor] Processing {file.name}")
+                    if rows:
+                        if not self._write_rows(file, rows):
+                            # DB failure: keep the file so the next sweep retries it
+                            continue
+                        written += 1
+                    # committed, or unparseable / empty (retrying won't help)
+                    try:
+                        file.unlink(missing_ok=True)
+                    except Exception:
+                        logger.logMessage(f"[SnapshotProcessor] Failed to unlink {file.name}")
+                except Exception as e:
+                    logger.logMessage(f"[SnapshotProcessor] Error processing {file.name}: {e}")
+        return written
+
+    @staticmethod
+    def _load_json(file_path: Path):
+        raw = file_path.read_bytes()
+        if orjson is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # orjson is strict (no NaN/Infinity, 64-bit ints); let json decide
+                pass
+        return json.loads(raw)
+
     # -------------------------
-    # Ingest single file with its own short transaction
+    # Ingest: parse (any thread) + write (one short transaction per file)
     # -------------------------
     def ingest_file(self, file_path: Union[str, Path]) -> None:
         file_path = Path(file_path)
+        rows = self._parse_file(file_path)
+        if rows:
+            self._write_rows(file_path, rows)
+
+    def _parse_file(self, file_path: Path) -> Optional[List[tuple]]:
+        """Read and decode one file into INSERT rows; None when there is nothing to write."""
         if not file_path.exists():
             logger.logMessage(f"[SnapshotProcessor] File not found: {file_path}")
-            return
+            return None
 
         try:
-            with file_path.open("r") as f:
-                data = json.load(f)
+            data = self._load_json(file_path)
         except Exception as e:
             logger.logMessage(f"[SnapshotProcessor] JSON load error for {file_path.name}: {e}")
-            return
+            return None
 
         if not data:
             logger.logMessage(f"[SnapshotProcessor] Empty JSON file: {file_path.name}")
-            return
+            return None
 
-        conn: Optional[sqlite3.Connection] = None
+        # build every row before taking the write lock, then bind them in one
+        # executemany (C loop over a single prepared statement)
+        rows = []
         try:
-            conn = self._get_conn()
-            cur = conn.cursor()
-
-            cols = (
-                "osiKey", "timestamp", "symbol", "optionType", "strikePrice",
-                "lastPrice", "bid", "ask", "bidSize", "askSize", "volume", "openInterest",
-                "nearPrice", "inTheMoney", "delta", "gamma", "theta", "vega", "rho", "iv",
-                "daysToExpiration", "spread", "midPrice", "moneyness"
-            )
-            placeholders = ", ".join(["?"] * len(cols))
-            sql = f"INSERT OR REPLACE INTO option_snapshots ({', '.join(cols)}) VALUES ({placeholders});"
-
-            # Do the entire file insert in a short transaction
-            conn.execute("BEGIN IMMEDIATE;")
             for entry in data:
                 # Defensive timestamp handling — mirror previous behavior
                 ts = entry.get("timestamp")
@@ -180,7 +354,7 @@ class OptionSnapshotProcessor(threading.Thread):
                 elif isinstance(ts, datetime):
                     ts = ts.isoformat()
 
-                params = (
+                rows.append((
                     entry.get("osiKey"),
                     ts,
                     entry.get("symbol"),
@@ -205,10 +379,26 @@ class OptionSnapshotProcessor(threading.Thread):
                     entry.get("spread"),
                     entry.get("midPrice"),
                     entry.get("moneyness"),
-                )
-                cur.execute(sql, params)
-            conn.execute("COMMIT;")
+                ))
+        except Exception as e:
+            logger.logMessage(f"[SnapshotProcessor] Bad snapshot entry in {file_path.name}: {e}")
+            return None
+        return rows
+
+    def _write_rows(self, file_path: Path, rows: List[tuple]) -> bool:
+        conn: Optional[sqlite3.Connection] = None
+        try:
+            if self.writer is not None:
+                # one unit on the shared writer; wait so the file is only unlinked once committed
+                self.writer.submit(INSERT_SNAPSHOT_SQL, rows).result(timeout=DEFAULT_RESULT_TIMEOUT)
+            else:
+                # Do the entire file insert in a short transaction
+                conn = self._conn()
+                conn.execute("BEGIN IMMEDIATE;")
+                conn.executemany(INSERT_SNAPSHOT_SQL, rows)
+                conn.execute("COMMIT;")
             logger.logMessage(f"[SnapshotProcessor] {file_path.name} added to DB (thread={threading.current_thread().name})")
+            return True
         except sqlite3.OperationalError as e:
             try:
                 if conn:
@@ -223,9 +413,4 @@ class OptionSnapshotProcessor(threading.Thread):
             except Exception:
                 pass
             logger.logMessage(f"[SnapshotProcessor] DB insert error for {file_path.name}: {e}")
-        finally:
-            if conn:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
+        return False
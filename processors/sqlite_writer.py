@@ -0,0 +1,237 @@
+# processors/sqlite_writer.py
+"""
+SqliteWriter
+- Owns the single write connection shared by the processors and applies queued work on one thread.
+- Units of work from any producer are coalesced: up to max_batch per BEGIN IMMEDIATE ... COMMIT.
+- Heavy (exclusive) units commit alone and queue behind light ones, so ingest is never stuck behind them.
+- Each unit runs under its own SAVEPOINT, so a failing unit rolls back alone.
+- Producers get a Future per unit, resolved only after the covering COMMIT.
+"""
+
+import itertools
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+from shared_options.log.logger_singleton import getLogger
+
+from processors.utils import is_busy_error
+
+logger = getLogger()
+
+DEFAULT_MAX_BATCH = 500
+DEFAULT_FLUSH_INTERVAL = 0.05  # seconds to wait for more units before committing
+DEFAULT_BEGIN_RETRIES = 5
+DEFAULT_RESULT_TIMEOUT = 300.0  # seconds producers wait on a Future before giving up
+
+# (sql, params): params is a tuple/dict for execute(), or a list of rows for executemany()
+Op = Tuple[str, Any]
+Unit = Tuple[List[Op], Future, bool]  # (ops, future, exclusive)
+
+# queue priorities: light units first, then exclusive ones, the stop sentinel last
+_PRIO_LIGHT = 0
+_PRIO_EXCLUSIVE = 1
+_PRIO_STOP = 2
+
+
+class SqliteWriter(threading.Thread):
+    def __init__(
+        self,
+        db_path: Union[str, Path],
+        max_batch: int = DEFAULT_MAX_BATCH,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        sqlite_timeout: float = 60.0,
+    ):
+        super().__init__(daemon=True, name="SqliteWriter")
+        self.db_path = Path(db_path)
+        self.max_batch = max(1, int(max_batch))
+        self.flush_interval = float(flush_interval)
+        self.sqlite_timeout = float(sqlite_timeout)
+
+        # (priority, seq, unit); seq keeps FIFO order within a priority
+        self._queue: "queue.PriorityQueue[Tuple[int, int, Optional[Unit]]]" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._stop_event = threading.Event()
+        # set once run() exits (including a failed connect): no consumer is left
+        self._dead = threading.Event()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # -------------------------
+    # DB helper
+    # -------------------------
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=self.sqlite_timeout, isolation_level=None)
+        try:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute(f"PRAGMA busy_timeout={int(self.sqlite_timeout * 1000)};")
+            conn.execute("PRAGMA foreign_keys=ON;")
+            # bulk writes: big page cache, mmap reads, in-memory temp b-trees,
+            # and fewer WAL checkpoints mid-transaction
+            conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
+            conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+            conn.execute("PRAGMA temp_store=MEMORY;")
+            conn.execute("PRAGMA wal_autocheckpoint=10000;")
+        except Exception:
+            pass
+        return conn
+
+    # -------------------------
+    # producer API (any thread)
+    # -------------------------
+    def submit(self, sql: str, params: Any = ()) -> Future:
+        """Queue one statement. A list of rows runs through executemany."""
+        return self.submit_unit([(sql, params)])
+
+    def submit_unit(self, ops: Sequence[Op], exclusive: bool = False) -> Future:
+        """
+        Queue statements that must commit (or roll back) together. The Future
+        resolves to the per-statement rowcounts once the transaction commits.
+        An exclusive unit gets a transaction of its own, after any light units.
+        """
+        fut: Future = Future()
+        if self._stop_event.is_set() or self._dead.is_set():
+            fut.set_exception(RuntimeError("SqliteWriter is stopped."))
+            return fut
+        self._put(_PRIO_EXCLUSIVE if exclusive else _PRIO_LIGHT, (list(ops), fut, bool(exclusive)))
+        if self._dead.is_set():
+            # the thread exited between the check and the put; don't strand the unit
+            self._fail_pending(RuntimeError("SqliteWriter is stopped."))
+        return fut
+
+    # -------------------------
+    # Thread control
+    # -------------------------
+    def stop(self, join_timeout: float = 10.0):
+        self._stop_event.set()
+        self._put(_PRIO_STOP, None)
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=join_timeout)
+
+    def run(self):
+        logger.logMessage("[SqliteWriter] Started")
+        conn: Optional[sqlite3.Connection] = None
+        try:
+            conn = self._get_conn()
+            while True:
+                units = self._next_units()
+                if units:
+                    self._apply(conn, units)
+                elif self._stop_event.is_set() and self._queue.empty():
+                    break
+        except Exception as e:
+            logger.logMessage(f"[SqliteWriter] Loop crash: {e}")
+        finally:
+            self._dead.set()
+            self._fail_pending(RuntimeError("SqliteWriter stopped before the write was applied."))
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        logger.logMessage("[SqliteWriter] Stopped")
+
+    # -------------------------
+    # internals (writer thread only)
+    # -------------------------
+    def _put(self, priority: int, unit: Optional[Unit]):
+        self._queue.put((priority, next(self._seq), unit))
+
+    def _next_units(self) -> List[Unit]:
+        """Block for the first unit, then gather more for up to flush_interval / max_batch."""
+        try:
+            _, _, first = self._queue.get(timeout=1.0)
+        except queue.Empty:
+            return []
+        if first is None:
+            return []
+        units = [first]
+        if first[2]:
+            return units
+        deadline = time.monotonic() + self.flush_interval
+        while len(units) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            unit = entry[2]
+            if unit is None or unit[2]:
+                # exclusive units and the stop sentinel wait for their own turn
+                self._queue.put(entry)
+                break
+            units.append(unit)
+        return units
+
+    def _begin(self, conn: sqlite3.Connection):
+        for attempt in range(1, DEFAULT_BEGIN_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == DEFAULT_BEGIN_RETRIES:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    def _apply(self, conn: sqlite3.Connection, units: List[Unit]):
+        # drop units whose producer cancelled before we got to them
+        units = [(ops, fut) for ops, fut, _ in units if fut.set_running_or_notify_cancel()]
+        if not units:
+            return
+        outcomes: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        try:
+            self._begin(conn)
+            cur = conn.cursor()
+            for ops, fut in units:
+                try:
+                    conn.execute("SAVEPOINT unit;")
+                    counts = []
+                    for sql, params in ops:
+                        if isinstance(params, list):
+                            cur.executemany(sql, params)
+                        else:
+                            cur.execute(sql, params)
+                        counts.append(max(cur.rowcount, 0))
+                    conn.execute("RELEASE unit;")
+                    outcomes.append((fut, counts, None))
+                except Exception as e:
+                    try:
+                        conn.execute("ROLLBACK TO unit;")
+                        conn.execute("RELEASE unit;")
+                    except Exception:
+                        pass
+                    outcomes.append((fut, None, e))
+            conn.execute("COMMIT;")
+        except Exception as e:
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK;")
+                except Exception:
+                    pass
+            logger.logMessage(f"[SqliteWriter] Transaction of {len(units)} units failed: {e}")
+            for _, fut in units:
+                fut.set_exception(e)
+            return
+
+        for fut, counts, err in outcomes:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(counts)
+
+    def _fail_pending(self, err: BaseException):
+        """Fail every queued unit; also called by submit_unit once the thread is gone."""
+        while True:
+            try:
+                _, _, unit = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if unit is not None and unit[1].set_running_or_notify_cancel():
+                unit[1].set_exception(err)
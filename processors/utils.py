@@ -5,18 +5,34 @@ def get_conn(self) -> sqlite3.Connection:
     Return a connection tuned for concurrency and reasonable timeouts.
     - sets WAL
     - sets busy_timeout (in milliseconds)
+    - sizes page cache, mmap and temp store for bulk writes
     - returns a connection object to be used for short-lived transactions
     """
     self.db_path.parent.mkdir(parents=True, exist_ok=True)
     # keep a generous timeout so connection attempts wait rather than error
     conn = sqlite3.connect(str(self.db_path), timeout=30.0, isolation_level=None)
     try:
+        # incremental free-page reclaim; only takes effect on a fresh file, and must come before WAL
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         # enable WAL and set busy timeout (30s)
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA synchronous=NORMAL;")
         conn.execute("PRAGMA busy_timeout=30000;")  # milliseconds
         conn.execute("PRAGMA foreign_keys=ON;")
+        # bulk writes: big page cache, mmap reads, in-memory temp b-trees
+        conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
+        conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+        conn.execute("PRAGMA temp_store=MEMORY;")
     except Exception:
         # ignore on constrained SQLite builds
         pass
     return conn
+
+
+def is_busy_error(e: sqlite3.OperationalError) -> bool:
+    """True for SQLITE_BUSY / SQLITE_LOCKED (worth retrying); schema, I/O etc. fail fast."""
+    code = getattr(e, "sqlite_errorcode", None)  # Python 3.11+
+    if code is not None:
+        return (code & 0xFF) in (5, 6)
+    msg = str(e).lower()
+    return "database is locked" in msg or "database is busy" in msg
@@ -1,12 +1,19 @@
 # routes/files_api.py
 
 from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
 import shutil
 
 router = APIRouter(prefix="/api", tags=["file-ingest"])
 
 SAVE_DIR = Path("data")
+COPY_BUFFER_SIZE = 1 << 20  # 1 MiB chunks: far fewer read/write calls than the 16 KiB default
+
+
+def _save_upload(src, dest: Path):
+    with dest.open("wb") as f:
+        shutil.copyfileobj(src, f, length=COPY_BUFFER_SIZE)
 
 @router.post("/upload_file")
 async def upload_file(file: UploadFile = File(...)):
@@ -18,8 +25,8 @@ async def upload_file(file: UploadFile = File(...)):
         SAVE_DIR.mkdir(parents=True, exist_ok=True)
         dest = SAVE_DIR / file.filename
 
-        with dest.open("wb") as f:
-            shutil.copyfileobj(file.file, f)
+        # blocking file I/O runs in the threadpool so the event loop keeps serving
+        await run_in_threadpool(_save_upload, file.file, dest)
 
         return {"status": "ok", "filename": file.filename}
 